@@ -6,14 +6,207 @@ Captures images at specified print layers with configurable grid coordinates.
 
 import os
 import json
+import heapq
+import logging
+import base64
 import time
+import queue
 import threading
+import concurrent.futures
+from dataclasses import dataclass
 from datetime import datetime
 
 import octoprint.plugin
 from octoprint.events import Events
 from octoprint.util import RepeatedTimer
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = ImageDraw = ImageFont = None
+
+# @ command queued behind M400, OctoPrint only processes it once the moves are done
+MOVE_DONE_ATCOMMAND = "LAYERCAPTURE_MOVED"
+
+# @ command marking a grid position, holds the send queue while the image is taken.
+# Holding blocks OctoPrint's send thread, which is acceptable only because the print is
+# paused and nothing but our own grid moves is queued; the hold is bounded by the
+# pre-capture delay plus this allowance for the snapshot itself.
+CAPTURE_ATCOMMAND = "LAYERCAPTURE_CAPTURE"
+CAPTURE_SNAPSHOT_ALLOWANCE = 10
+
+# Tag prefix for a sequence's queued grid commands, they are dropped from the send queue once the print ends
+GRID_COMMAND_TAG = "plugin:layercapture:"
+
+# Longest time the print stays paused waiting for background file writes to finish
+PENDING_WRITES_TIMEOUT = 30
+
+# Write buffer for webcam snapshots, large enough to hold a typical frame in one flush
+SNAPSHOT_WRITE_BUFFER = 1024 * 1024
+
+# G1 templates for moves with and without a Z target
+MOVE_XY_GCODE = "G1 X%s Y%s F%d"
+MOVE_XYZ_GCODE = "G1 X%s Y%s Z%s F%d"
+
+# 8x8 grey JPEG, encoded once and reused whenever a fake image can't be rendered or isn't wanted
+PLACEHOLDER_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkz"
+    "ODdASFxOQERXRTc4UG1RV19iZ2hnPk1xeXBkeFxlZ2P/wAALCAAIAAgBAREA/8QAFAABAAAAAAAA"
+    "AAAAAAAAAAAAAP/EABQQAQAAAAAAAAAAAAAAAAAAAAD/2gAIAQEAAD8AP//Z"
+)
+
+
+def _format_coordinate(value):
+    """Format a coordinate with at most three decimals and no trailing zeros (105.0 -> 105)"""
+    formatted = f"{value:.3f}".rstrip("0").rstrip(".")
+    return "0" if formatted == "-0" else formatted
+
+
+def _dump_json(obj):
+    """Serialize to indented JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2)
+        except TypeError:
+            pass
+    return json.dumps(obj, indent=2).encode("utf-8")
+
+
+class TargetLayers:
+    """Set-like collection of the layer numbers to capture
+    
+    The "every N layers" part is kept as a ``range`` so membership is plain
+    arithmetic instead of building and hashing a set of every target layer.
+    Additional layers are flagged in a ``bytearray`` indexed by layer number.
+    The collection is built once per print and not modified afterwards.
+    """
+    
+    def __init__(self, every_n=0, max_layer=0, extra_layers=()):
+        self._periodic = range(every_n, max_layer + 1, every_n) if every_n > 0 else range(0)
+        self._extra = bytearray(max_layer + 1)
+        self._extra_count = 0
+        for layer in extra_layers:
+            self._add(layer)
+    
+    def _add(self, layer):
+        if layer < 0 or layer in self._periodic:
+            return
+        if layer >= len(self._extra):
+            self._extra.extend(bytes(layer + 1 - len(self._extra)))
+        if not self._extra[layer]:
+            self._extra[layer] = 1
+            self._extra_count += 1
+    
+    def next_after(self, layer):
+        """Smallest target layer above ``layer``, or None if there is none"""
+        candidates = []
+        periodic = self._periodic
+        if periodic:
+            if layer < periodic.start:
+                candidates.append(periodic.start)
+            else:
+                following = layer + periodic.step - (layer - periodic.start) % periodic.step
+                if following in periodic:
+                    candidates.append(following)
+        following = self._extra.find(1, max(layer + 1, 0))
+        if following != -1:
+            candidates.append(following)
+        return min(candidates) if candidates else None
+    
+    def __contains__(self, layer):
+        return layer in self._periodic or (0 <= layer < len(self._extra) and self._extra[layer] == 1)
+    
+    def __iter__(self):
+        # Both sources are already ascending and disjoint, so merge instead of sorting
+        extra = (layer for layer, flag in enumerate(self._extra) if flag)
+        return heapq.merge(self._periodic, extra)
+    
+    def __len__(self):
+        return len(self._periodic) + self._extra_count
+
+
+@dataclass(frozen=True)
+class CaptureConfig:
+    """Immutable snapshot of the settings read on the capture hot paths"""
+    
+    # Layer tracking
+    min_layer_height: float
+    max_z: float
+    capture_every_n: int
+    capture_z_heights: tuple
+    
+    # 3D grid, with fallback to the legacy single-axis settings
+    grid_center_x: float
+    grid_center_y: float
+    grid_center_z: float
+    grid_size_x: int
+    grid_size_y: int
+    grid_size_z: int
+    spacing_x: float
+    spacing_y: float
+    spacing_z: float
+    z_offset: float
+    
+    # Bed boundaries
+    bed_w: float
+    bed_h: float
+    margin: float
+    
+    # Capture behaviour
+    pre_capture_delay: float
+    return_to_origin: bool
+    save_meta: bool
+    use_fake: bool
+    fake_minimal: bool
+    create_thumbnails: bool
+    image_quality: int
+    capture_folder: str
+    
+    # Printer motion and pause handling
+    movement_speed: int
+    movement_timeout: int
+    pause_timeout: int
+    emergency_attempts: int
+    
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            min_layer_height=settings.get_float(["min_layer_height"]),
+            max_z=settings.get_float(["max_z_height"]),
+            capture_every_n=settings.get_int(["capture_every_n_layers"]),
+            capture_z_heights=tuple(settings.get(["capture_z_heights"]) or ()),
+            grid_center_x=settings.get_float(["grid_center_x"]),
+            grid_center_y=settings.get_float(["grid_center_y"]),
+            grid_center_z=settings.get_float(["grid_center_z"]),
+            grid_size_x=settings.get_int(["grid_size_x"]) or settings.get_int(["grid_size"]),
+            grid_size_y=settings.get_int(["grid_size_y"]) or settings.get_int(["grid_size"]),
+            grid_size_z=settings.get_int(["grid_size_z"]) or 1,
+            spacing_x=settings.get_float(["grid_spacing_x"]) or settings.get_float(["grid_spacing"]),
+            spacing_y=settings.get_float(["grid_spacing_y"]) or settings.get_float(["grid_spacing"]),
+            spacing_z=settings.get_float(["grid_spacing_z"]) or 5.0,
+            z_offset=settings.get_float(["z_offset_base"]) or settings.get_float(["z_offset"]),
+            bed_w=settings.get_float(["bed_width"]) or settings.get_float(["bed_max_x"]),
+            bed_h=settings.get_float(["bed_height"]) or settings.get_float(["bed_max_y"]),
+            margin=settings.get_float(["boundary_margin"]),
+            pre_capture_delay=settings.get_float(["pre_capture_delay"]),
+            return_to_origin=settings.get_boolean(["return_to_origin"]),
+            save_meta=settings.get_boolean(["save_metadata"]),
+            use_fake=settings.get_boolean(["use_fake_camera"]),
+            fake_minimal=settings.get_boolean(["fake_minimal"]),
+            create_thumbnails=settings.get_boolean(["create_thumbnails"]),
+            image_quality=settings.get_int(["image_quality"]),
+            capture_folder=settings.get(["capture_folder"]),
+            movement_speed=settings.get_int(["movement_speed"]),
+            movement_timeout=settings.get_int(["movement_timeout"]),
+            pause_timeout=settings.get_int(["pause_timeout"]),
+            emergency_attempts=settings.get_int(["emergency_resume_attempts"]),
+        )
+
 
 class LayerCapturePlugin(
     octoprint.plugin.EventHandlerPlugin,
@@ -25,14 +218,45 @@ class LayerCapturePlugin(
 ):
     
     def __init__(self):
-        self._capture_queue = []
         self._capture_in_progress = False
-        self._current_layer = 0
-        self._target_layers = set()
+        self._last_z = None
+        self._next_target_z = float("inf")
+        self._target_layers = TargetLayers()
+        self._target_layer_list = []
         self._print_start_time = None
+        self._print_start_time_iso = None
         self._current_gcode_file = None
         self._current_calibration_file = "calibTODO.json" # Initialize calibration file path
-        self._capture_mutex = threading.Lock()
+        self._metadata_template = None
+        
+        # Single long-lived worker serializes capture sequences
+        self._capture_q = queue.Queue()
+        self._capture_thread = threading.Thread(target=self._capture_worker, name="LayerCaptureWorker")
+        self._capture_thread.daemon = True
+        self._capture_thread.start()
+        
+        # Set by the @ command hook once queued moves have finished
+        self._move_done = threading.Event()
+        # Carried by each move's marker so a late marker from an earlier move can't complete this one
+        self._move_token = 0
+        self._print_paused = threading.Event()
+        self._print_resumed = threading.Event()
+        self._printer_error = threading.Event()
+        # Set when the print session ends (done, failed or cancelled)
+        self._print_ended = threading.Event()
+        # (sequence token, slots) of the running grid, swapped as one so markers match their sequence
+        self._capture_slots = (0, [])
+        self._capture_token = 0
+        self._last_known_pos = None
+        
+        # Background writers so file I/O overlaps with the next grid move
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="LayerCaptureIO")
+        self._pending_writes = []
+        
+        # Static part of the fake camera image and its fonts, prepared on first use
+        self._fake_base = None
+        self._fake_fonts = None
+        self._fake_crosshair = None
         
     ##~~ SettingsPlugin mixin
     
@@ -69,7 +293,8 @@ class LayerCapturePlugin(
             
             # Camera configuration
             "use_fake_camera": True,  # For debugging without real camera
-            "capture_delay": 2,  # Delay between movements and capture in seconds
+            "fake_minimal": False,  # Fake camera writes a tiny placeholder JPEG instead of rendering a scene
+            "capture_delay": 2,  # Unused, moves are awaited with M400; kept so saved configs stay valid
             "pre_capture_delay": 0.5,  # Additional delay before taking snapshot
             "create_thumbnails": True,  # Create thumbnails for web viewing
             "image_quality": 95,  # JPEG quality (1-100)
@@ -93,6 +318,28 @@ class LayerCapturePlugin(
             "boundary_margin": 10,  # Safety margin from bed edges in mm
         }
     
+    def on_settings_save(self, data):
+        diff = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self._refresh_settings_cache()
+        return diff
+    
+    def initialize(self):
+        self._refresh_settings_cache()
+    
+    def _refresh_settings_cache(self):
+        """Snapshot settings into a CaptureConfig so hot paths skip settings lookups"""
+        self._cfg = CaptureConfig.from_settings(self._settings)
+        self._inv_min_layer_height = 1.0 / max(self._cfg.min_layer_height, 1e-6)
+        
+        # Capture root within uploads, date folders below it are created lazily
+        self._capture_root = os.path.join(self._file_manager.get_folder_path("uploads"), self._cfg.capture_folder)
+        self._capture_dir = None
+        
+        self._grid_lattice = self._calculate_grid_lattice()
+        self._cached_target_layers = self._calculate_target_layers()
+        # Sorted list form for status responses and plugin messages
+        self._cached_target_layer_list = list(self._cached_target_layers)
+    
     ##~~ TemplatePlugin mixin
     
     def get_template_configs(self):
@@ -124,8 +371,8 @@ class LayerCapturePlugin(
     def on_api_command(self, command, data):
         if command == "status":
             return {
-                "current_layer": self._current_layer,
-                "target_layers": sorted(self._target_layers),
+                "current_layer": self._calculate_layer_number(self._last_z) if self._last_z else 0,
+                "target_layers": self._target_layer_list,
                 "capture_in_progress": self._capture_in_progress,
                 "print_start_time": self._print_start_time,
                 "current_gcode_file": self._current_gcode_file
@@ -146,28 +393,43 @@ class LayerCapturePlugin(
             self._on_print_cancelled(payload)
         elif event == Events.Z_CHANGE:
             self._on_z_change(payload)
+        elif event == Events.PRINT_PAUSED:
+            self._print_paused.set()
+        elif event == Events.PRINT_RESUMED:
+            self._print_resumed.set()
+        elif event == Events.ERROR:
+            # Wake every state waiter so it re-checks the printer instead of sitting out its timeout
+            self._printer_error.set()
+            self._print_paused.set()
+            self._print_resumed.set()
     
     def _on_print_started(self, payload):
         """Initialize capture session when print starts"""
         self._logger.info("Print started, initializing layer capture")
         self._print_start_time = time.time()
-        self._current_layer = 0
+        self._print_start_time_iso = datetime.fromtimestamp(self._print_start_time).isoformat()
+        self._last_z = None
+        self._printer_error.clear()
+        self._print_ended.clear()
         self._current_gcode_file = payload.get("file", {}).get("path")
         self._current_calibration_file = self._settings.get(["calibration_file_path"])  # Store calibration file path
-        self._capture_queue.clear()
+        self._metadata_template = self._build_metadata_template()
         
-        # Calculate target layers based on settings
-        self._calculate_target_layers()
+        # Target layers are precomputed whenever settings change
+        self._target_layers = self._cached_target_layers
+        self._target_layer_list = self._cached_target_layer_list
+        self._next_target_z = self._next_target_z_after(0)
         
         # Log print information
         file_info = payload.get("file", {})
-        self._logger.info(f"Print file: {file_info.get('name', 'Unknown')}")
-        self._logger.info(f"Target layers for capture: {sorted(self._target_layers)}")
+        self._logger.info("Print file: %s", file_info.get('name', 'Unknown'))
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info("Target layers for capture: %s", self._target_layer_list)
         
         # Send notification to frontend
         self._plugin_manager.send_plugin_message("layercapture", {
             "type": "print_started",
-            "target_layers": sorted(self._target_layers),
+            "target_layers": self._target_layer_list,
             "file_name": file_info.get("name", "Unknown"),
             "calibration_file_path": self._current_calibration_file
         })
@@ -189,74 +451,89 @@ class LayerCapturePlugin(
     
     def _on_z_change(self, payload):
         """Handle layer changes and trigger captures"""
+        # Z changes during a sequence come from our own grid and return moves, not the print
+        if self._capture_in_progress:
+            return
+        
         old_z = payload.get("old")
         new_z = payload.get("new")
         
-        if new_z is None:
+        # Repeated reports of the same Z can't change the layer
+        if new_z is None or new_z == self._last_z:
             return
-            
-        # Calculate current layer with better precision
-        min_layer_height = self._settings.get_float(["min_layer_height"])
-        current_layer = self._calculate_layer_number(new_z, min_layer_height)
+        self._last_z = new_z
         
-        if current_layer != self._current_layer and current_layer > 0:
-            self._current_layer = current_layer
-            self._logger.debug(f"Layer changed to {current_layer} at Z={new_z:.3f}")
-            
-            # Check if we should capture at this layer
-            if current_layer in self._target_layers:
-                self._logger.info(f"Triggering capture for layer {current_layer} at Z={new_z:.3f}")
-                self._trigger_layer_capture(current_layer, new_z)
-            else:
-                self._logger.debug(f"Layer {current_layer} not in target layers: {sorted(self._target_layers)}")
+        # Z went down (start G-code lift, next object of a sequential print), so targets
+        # below the threshold are reachable again; start from the current layer
+        if old_z is not None and new_z < old_z:
+            self._next_target_z = self._next_target_z_after(round(new_z * self._inv_min_layer_height) - 1)
+        
+        # Nothing can trigger until Z reaches the next target layer
+        if new_z < self._next_target_z:
+            return
+        
+        # Same quantization as _calculate_layer_number, inlined for this per-event path
+        current_layer = round(new_z * self._inv_min_layer_height)
+        
+        # Above the threshold but not on a target, e.g. a Z hop across layers; keep the threshold
+        if current_layer not in self._target_layers:
+            self._logger.debug("Layer %d not in target layers (count=%d)", current_layer, len(self._target_layers))
+            return
+        
+        self._logger.info("Triggering capture for layer %d at Z=%.3f", current_layer, new_z)
+        # Only move past this layer once its capture is actually queued
+        if self._trigger_layer_capture(current_layer, new_z):
+            self._next_target_z = self._next_target_z_after(current_layer)
     
-    def _calculate_layer_number(self, z_height, min_layer_height):
+    def _calculate_layer_number(self, z_height):
         """Calculate layer number from Z height with better precision"""
         if z_height <= 0:
             return 0
             
-        # Use rounding to handle floating point precision issues
-        layer = round(z_height / min_layer_height)
-        
-        # Ensure we don't have negative layers
-        return max(0, layer)
+        # Use rounding to handle floating point precision issues,
+        # multiplying by the cached inverse instead of dividing
+        return round(z_height * self._inv_min_layer_height)
+    
+    def _next_target_z_after(self, layer):
+        """Lowest Z that rounds to the next target layer above ``layer``"""
+        next_layer = self._target_layers.next_after(layer)
+        if next_layer is None:
+            return float("inf")
+        return (next_layer - 0.5) * self._cfg.min_layer_height
     
     def _calculate_target_layers(self):
         """Calculate which layers to capture based on settings"""
-        self._target_layers.clear()
+        capture_every_n = self._cfg.capture_every_n
+        min_layer_height = self._cfg.min_layer_height
+        max_z_height = self._cfg.max_z
         
-        capture_every_n = self._settings.get_int(["capture_every_n_layers"])
-        min_layer_height = self._settings.get_float(["min_layer_height"])
-        max_z_height = self._settings.get_float(["max_z_height"])
+        # Specific Z heights if configured
+        extra_layers = []
+        for z_height in self._cfg.capture_z_heights:
+            if z_height > 0:
+                layer = self._calculate_layer_number(z_height)
+                extra_layers.append(layer)
+                self._logger.debug("Added specific Z height %smm as layer %d", z_height, layer)
         
-        if capture_every_n > 0:
-            # Calculate target layers based on max Z height
-            max_layers = int(max_z_height / min_layer_height)
-            for layer in range(capture_every_n, max_layers + 1, capture_every_n):
-                self._target_layers.add(layer)
-            
-            self._logger.info(f"Calculated {len(self._target_layers)} target layers every {capture_every_n} layers")
+        # Build the whole collection at once, based on max Z height
+        max_layers = int(max_z_height / min_layer_height)
+        target_layers = TargetLayers(capture_every_n, max_layers, extra_layers)
         
-        # Add specific Z heights if configured
-        z_heights = self._settings.get(["capture_z_heights"])
-        for z_height in z_heights:
-            if z_height > 0:
-                layer = self._calculate_layer_number(z_height, min_layer_height)
-                self._target_layers.add(layer)
-                self._logger.debug(f"Added specific Z height {z_height}mm as layer {layer}")
+        if capture_every_n > 0:
+            self._logger.info("Calculated %d target layers every %d layers", len(target_layers), capture_every_n)
         
-        self._logger.info(f"Total target layers: {sorted(self._target_layers)}")
+        return target_layers
     
     def _trigger_layer_capture(self, layer, z_height):
-        """Trigger the capture sequence for a specific layer"""
+        """Trigger the capture sequence for a specific layer, returns whether it was queued"""
         if self._capture_in_progress:
-            self._logger.warning(f"Capture already in progress, skipping layer {layer}")
-            return
+            self._logger.warning("Capture already in progress, skipping layer %d", layer)
+            return False
         
         # Validate printer state before capture
         if not self._validate_printer_state():
-            self._logger.warning(f"Printer not in safe state for capture, skipping layer {layer}")
-            return
+            self._logger.warning("Printer not in safe state for capture, skipping layer %d", layer)
+            return False
         
         # Add to capture queue
         capture_data = {
@@ -264,15 +541,27 @@ class LayerCapturePlugin(
             "z_height": z_height,
             "timestamp": time.time(),
             "gcode_file": self._current_gcode_file,
-            "calibration_file_path": self._current_calibration_file  # Add calibration file path to capture data
+            "calibration_file_path": self._current_calibration_file,  # Add calibration file path to capture data
+            # Held by the sequence itself, session cleanup may clear the attribute while it runs
+            "metadata_template": self._metadata_template
         }
         
-        self._capture_queue.append(capture_data)
-        
-        # Start capture sequence in background thread
-        capture_thread = threading.Thread(target=self._execute_capture_sequence, args=(capture_data,))
-        capture_thread.daemon = True
-        capture_thread.start()
+        # Hand off to the capture worker thread. The flag is a plain attribute:
+        # only this event handler sets it and only the single worker clears it.
+        self._capture_in_progress = True
+        self._capture_q.put(capture_data)
+        return True
+    
+    def _capture_worker(self):
+        """Consume queued capture requests one at a time"""
+        while True:
+            capture_data = self._capture_q.get()
+            try:
+                self._execute_capture_sequence(capture_data)
+            except Exception as e:
+                self._logger.exception("Unhandled error in capture worker: %s", e)
+            finally:
+                self._capture_q.task_done()
     
     def _validate_printer_state(self):
         """Validate that printer is in a safe state for capture"""
@@ -295,109 +584,166 @@ class LayerCapturePlugin(
             return True
             
         except Exception as e:
-            self._logger.error(f"Error validating printer state: {e}")
+            self._logger.error("Error validating printer state: %s", e)
             return False
     
     def _execute_capture_sequence(self, capture_data):
         """Execute the complete capture sequence"""
-        with self._capture_mutex:
-            self._capture_in_progress = True
-            original_position = None
-            print_resumed = False
+        original_position = None
+        print_resumed = False
+        
+        try:
+            self._logger.info("Starting capture sequence for layer %d", capture_data['layer'])
+            
+            # One timestamp and filename prefix for every file written by this sequence,
+            # taken from the clock read made when the capture was triggered
+            capture_time = datetime.fromtimestamp(capture_data["timestamp"])
+            capture_data["timestamp_iso"] = capture_time.isoformat()
+            timestamp = capture_time.strftime("%Y%m%d_%H%M%S")
+            layer_prefix = f"layer_{capture_data['layer']:04d}"
+            z_height_str = f"{capture_data['z_height']:.2f}".replace('.', '_')
+            image_name_template = f"{layer_prefix}_pos_{{:02d}}_z_{z_height_str}_{timestamp}.jpg"
+            capture_dir = self._get_capture_dir(capture_time)
+            
+            # Send notification to frontend
+            self._plugin_manager.send_plugin_message("layercapture", {
+                "type": "capture_started",
+                "layer": capture_data["layer"],
+                "z_height": capture_data["z_height"]
+            })
             
+            # 1. Pause the print safely
+            if not self._pause_print_safely():
+                raise Exception("Failed to pause print safely")
+            
+            # 2. Get and store current position
+            original_position = self._get_current_position()
+            if not original_position:
+                raise Exception("Could not determine current position")
+            
+            self._logger.debug("Original position: %s", original_position)
+            self._last_known_pos = original_position
+            
+            # 3. Calculate grid positions
+            grid_positions = self._calculate_grid_positions(capture_data["z_height"])
+            if not grid_positions:
+                raise Exception("No valid grid positions calculated")
+            
+            self._logger.info("Calculated %d capture positions", len(grid_positions))
+            
+            # 4. Queue the whole traversal at once, then capture as each position is reached
+            # Bound locally, session cleanup may replace the attribute from the event thread
+            # Per position: reached, released, and expired when the hold ran out before the capture finished
+            slots = [(threading.Event(), threading.Event(), threading.Event()) for _ in grid_positions]
+            self._capture_token += 1
+            token = self._capture_token
+            self._capture_slots = (token, slots)
+            # Every grid position has a Z target, so the XYZ template applies to all of them
+            speed = self._cfg.movement_speed
+            commands = []
+            # XY travel only ever happens at the top Z of the grid: rise in place first, so the
+            # nozzle never crosses the print at the low grid heights
+            xy = (_format_coordinate(original_position["x"]), _format_coordinate(original_position["y"]))
+            top_z = None
+            for i, position in enumerate(grid_positions):
+                target_xy = (_format_coordinate(position["x"]), _format_coordinate(position["y"]))
+                z = _format_coordinate(position["z"])
+                if target_xy != xy:
+                    commands.append(MOVE_XYZ_GCODE % (xy[0], xy[1], z, speed))
+                    xy, top_z = target_xy, z
+                commands += [MOVE_XYZ_GCODE % (xy[0], xy[1], z, speed), "M400", "@%s %d %d" % (CAPTURE_ATCOMMAND, token, i)]
+            # Leave the last XY point from the top too, the return move travels from there
+            if top_z is not None and top_z != z:
+                commands.append(MOVE_XYZ_GCODE % (xy[0], xy[1], top_z, speed))
+            self._printer.commands(commands, tags={f"{GRID_COMMAND_TAG}{token}"})
+            
+            captured_images = []
+            movement_timeout = self._cfg.movement_timeout
             try:
-                self._logger.info(f"Starting capture sequence for layer {capture_data['layer']}")
-                
-                # Send notification to frontend
-                self._plugin_manager.send_plugin_message("layercapture", {
-                    "type": "capture_started",
-                    "layer": capture_data["layer"],
-                    "z_height": capture_data["z_height"]
-                })
-                
-                # 1. Pause the print safely
-                if not self._pause_print_safely():
-                    raise Exception("Failed to pause print safely")
-                
-                # 2. Get and store current position
-                original_position = self._get_current_position()
-                if not original_position:
-                    raise Exception("Could not determine current position")
-                
-                self._logger.debug(f"Original position: {original_position}")
-                
-                # 3. Calculate grid positions
-                grid_positions = self._calculate_grid_positions(capture_data["z_height"])
-                if not grid_positions:
-                    raise Exception("No valid grid positions calculated")
-                
-                self._logger.info(f"Calculated {len(grid_positions)} capture positions")
-                
-                # 4. Move to each position and capture
-                captured_images = []
                 for i, position in enumerate(grid_positions):
-                    self._logger.debug(f"Processing position {i+1}/{len(grid_positions)}: {position}")
-                    
-                    # Move to position with safety checks
-                    if not self._move_to_position_safely(position):
-                        self._logger.warning(f"Failed to move to position {i+1}, skipping capture")
-                        continue
-                    
-                    # Wait for movement to complete and stabilize
-                    time.sleep(self._settings.get_int(["capture_delay"]))
-                    
-                    # Capture image
-                    image_path = self._capture_image(capture_data, i)
-                    if image_path:
-                        captured_images.append({
-                            "path": image_path,
-                            "position": position,
-                            "index": i
-                        })
-                        self._logger.debug(f"Successfully captured image {i+1}: {image_path}")
-                
-                # 5. Return to original position safely
-                if self._settings.get_boolean(["return_to_origin"]) and original_position:
-                    self._logger.debug("Returning to original position")
-                    if not self._move_to_position_safely(original_position):
-                        self._logger.warning("Failed to return to original position")
-                    else:
-                        time.sleep(1)  # Stabilize after return movement
-                
-                # 6. Save metadata
-                if self._settings.get_boolean(["save_metadata"]):
-                    self._save_capture_metadata(capture_data, captured_images)
-                
-                # 7. Resume print safely
-                if self._resume_print_safely():
-                    print_resumed = True
-                    self._logger.info(f"Capture sequence completed for layer {capture_data['layer']}, captured {len(captured_images)} images")
+                    reached, released, expired = slots[i]
+                    try:
+                        self._logger.debug("Processing position %d/%d: %s", i + 1, len(grid_positions), position)
+                        
+                        # Wait for the printer to arrive at the position
+                        reached_in_time = reached.wait(timeout=movement_timeout)
+                        if self._session_aborted():
+                            break
+                        if not reached_in_time:
+                            self._logger.warning("Failed to move to position %d, skipping capture", i + 1)
+                            self._last_known_pos = None
+                            continue
+                        self._last_known_pos = position
+                        
+                        # Capture image
+                        image_path = self._capture_image(capture_data, i, capture_dir, image_name_template)
+                        if image_path and expired.is_set():
+                            # The printer already moved on, so the image doesn't show this position
+                            self._logger.warning("Hold at position %d expired during capture, dropping image %s", i + 1, image_path)
+                        elif image_path:
+                            captured_images.append({
+                                "path": image_path,
+                                "position": position,
+                                "index": i
+                            })
+                            self._logger.debug("Successfully captured image %d: %s", i + 1, image_path)
+                    finally:
+                        # Let the printer continue to the next position
+                        released.set()
+            finally:
+                self._release_capture_slots()
+            
+            # The print was cancelled or failed during the grid, don't move or resume it
+            if self._session_aborted():
+                self._logger.info("Print ended during capture of layer %d, skipping return and resume", capture_data['layer'])
+                self._wait_for_pending_writes()
+                return
+            
+            # 5. Return to original position safely
+            if self._cfg.return_to_origin and original_position:
+                self._logger.debug("Returning to original position")
+                if not self._move_to_position_safely(original_position):
+                    self._logger.warning("Failed to return to original position")
                 else:
-                    raise Exception("Failed to resume print")
-                
-                # Send success notification
-                self._plugin_manager.send_plugin_message("layercapture", {
-                    "type": "capture_completed",
-                    "layer": capture_data["layer"],
-                    "images_count": len(captured_images)
-                })
-                
-            except Exception as e:
-                self._logger.error(f"Error during capture sequence: {e}")
-                
-                # Send error notification
-                self._plugin_manager.send_plugin_message("layercapture", {
-                    "type": "capture_failed",
-                    "layer": capture_data["layer"],
-                    "error": str(e)
-                })
+                    time.sleep(1)  # Stabilize after return movement
+            
+            # 6. Save metadata
+            if self._cfg.save_meta:
+                self._save_capture_metadata(capture_data, captured_images, capture_dir, f"{layer_prefix}_metadata_{timestamp}.json")
+            
+            # 7. Let this sequence's files land before the print takes the CPU back
+            self._wait_for_pending_writes()
+            
+            # 8. Resume print safely
+            if self._resume_print_safely():
+                print_resumed = True
+                self._logger.info("Capture sequence completed for layer %d, captured %d images", capture_data['layer'], len(captured_images))
+            else:
+                raise Exception("Failed to resume print")
+            
+            # Send success notification
+            self._plugin_manager.send_plugin_message("layercapture", {
+                "type": "capture_completed",
+                "layer": capture_data["layer"],
+                "images_count": len(captured_images)
+            })
+            
+        except Exception as e:
+            self._logger.error("Error during capture sequence: %s", e)
+            
+            # Send error notification
+            self._plugin_manager.send_plugin_message("layercapture", {
+                "type": "capture_failed",
+                "layer": capture_data["layer"],
+                "error": str(e)
+            })
+            
+            # Emergency recovery: try to resume print, unless it already ended or errored
+            if not print_resumed and not self._session_aborted():
+                self._emergency_resume_print()
                 
-                # Emergency recovery: try to resume print
-                if not print_resumed:
-                    self._emergency_resume_print()
-                    
-            finally:
-                self._capture_in_progress = False
+        finally:
+            self._capture_in_progress = False
     
     def _get_current_position(self):
         """Get current printer position"""
@@ -411,99 +757,173 @@ class LayerCapturePlugin(
                     "z": current_pos.get("z", 0)
                 }
         except Exception as e:
-            self._logger.warning(f"Could not get current position: {e}")
+            self._logger.warning("Could not get current position: %s", e)
         
         # Fallback to safe position
         return {"x": 100, "y": 100, "z": 10}
     
-    def _calculate_grid_positions(self, z_height=None):
-        """Calculate 3D grid positions for image capture"""
-        # Get 3D grid configuration with fallback to legacy settings
-        center_x = self._settings.get_float(["grid_center_x"])
-        center_y = self._settings.get_float(["grid_center_y"])
-        center_z = self._settings.get_float(["grid_center_z"])
+    def _calculate_grid_lattice(self):
+        """Precompute the XY grid and relative Z offsets, which don't change between layers"""
+        center_x = self._cfg.grid_center_x
+        center_y = self._cfg.grid_center_y
+        center_z = self._cfg.grid_center_z
         
-        # Use new axis-specific settings with fallback to legacy
-        grid_size_x = self._settings.get_int(["grid_size_x"]) or self._settings.get_int(["grid_size"])
-        grid_size_y = self._settings.get_int(["grid_size_y"]) or self._settings.get_int(["grid_size"])
-        grid_size_z = self._settings.get_int(["grid_size_z"]) or 1
+        spacing_x = self._cfg.spacing_x
+        spacing_y = self._cfg.spacing_y
+        spacing_z = self._cfg.spacing_z
         
-        spacing_x = self._settings.get_float(["grid_spacing_x"]) or self._settings.get_float(["grid_spacing"])
-        spacing_y = self._settings.get_float(["grid_spacing_y"]) or self._settings.get_float(["grid_spacing"])
-        spacing_z = self._settings.get_float(["grid_spacing_z"]) or 5.0
+        z_offset_base = self._cfg.z_offset
         
-        z_offset_base = self._settings.get_float(["z_offset_base"]) or self._settings.get_float(["z_offset"])
+        # Safe XY area inside the bed boundaries
+        x_min = y_min = self._cfg.margin
+        x_max = self._cfg.bed_w - self._cfg.margin
+        y_max = self._cfg.bed_h - self._cfg.margin
         
-        positions = []
+        lattice = []
         
         # Calculate 3D grid positions around center
-        half_size_x = grid_size_x // 2
-        half_size_y = grid_size_y // 2
-        half_size_z = grid_size_z // 2
-        
-        for x_offset in range(-half_size_x, half_size_x + 1):
-            for y_offset in range(-half_size_y, half_size_y + 1):
-                for z_offset in range(-half_size_z, half_size_z + 1):
-                    x = center_x + (x_offset * spacing_x)
-                    y = center_y + (y_offset * spacing_y)
-                    
-                    # Calculate Z position
-                    if z_height is not None:
-                        # Z position = current layer height + base offset + grid Z offset
-                        z = z_height + z_offset_base + center_z + (z_offset * spacing_z)
-                    else:
-                        # If no layer height provided, use base offset only
-                        z = z_offset_base + center_z + (z_offset * spacing_z)
-                    
-                    # Validate position is within bed boundaries
-                    if self._is_position_safe(x, y, z):
-                        position = {
-                            "x": x, 
-                            "y": y, 
-                            "z": z,
-                            "grid_coords": {
-                                "x_offset": x_offset,
-                                "y_offset": y_offset,
-                                "z_offset": z_offset
-                            }
-                        }
-                        positions.append(position)
-        
-        self._logger.debug(f"Calculated {len(positions)} 3D grid positions ({grid_size_x}x{grid_size_y}x{grid_size_z})")
+        half_size_x = self._cfg.grid_size_x // 2
+        half_size_y = self._cfg.grid_size_y // 2
+        half_size_z = self._cfg.grid_size_z // 2
+        
+        # Serpentine traversal: every other column runs Y backwards so the head never
+        # jumps back across the grid. Z runs top-down at every XY point, the capture
+        # sequence lifts back to the top before travelling to the next one.
+        y_offsets = range(-half_size_y, half_size_y + 1)
+        z_offsets = range(-half_size_z, half_size_z + 1)
+        
+        for column, x_offset in enumerate(range(-half_size_x, half_size_x + 1)):
+            for y_offset in (reversed(y_offsets) if column % 2 else y_offsets):
+                # Quantize to G-code precision so float noise never reaches the printer
+                x = round(center_x + (x_offset * spacing_x), 3)
+                y = round(center_y + (y_offset * spacing_y), 3)
+                
+                # Validate position is within bed boundaries
+                if not (x_min <= x <= x_max and y_min <= y <= y_max):
+                    continue
+                
+                for z_offset in reversed(z_offsets):
+                    # Z relative to the layer height = base offset + grid Z offset
+                    z_relative = z_offset_base + center_z + (z_offset * spacing_z)
+                    lattice.append((x, y, z_relative, (x_offset, y_offset, z_offset)))
+        
+        return lattice
+    
+    def _calculate_grid_positions(self, z_height=None):
+        """Calculate 3D grid positions for image capture"""
+        max_z = self._cfg.max_z
+        base_z = z_height if z_height is not None else 0
+        
+        # Z position = current layer height + base offset + grid Z offset;
+        # XY bounds were already applied when the lattice was built
+        positions = [
+            {
+                "x": x,
+                "y": y,
+                "z": base_z + z_relative,
+                "grid_coords": {
+                    "x_offset": x_offset,
+                    "y_offset": y_offset,
+                    "z_offset": z_offset
+                }
+            }
+            for x, y, z_relative, (x_offset, y_offset, z_offset) in self._grid_lattice
+            if 0 <= base_z + z_relative <= max_z
+        ]
+        
+        self._logger.debug("Calculated %d 3D grid positions (%dx%dx%d)", len(positions), self._cfg.grid_size_x, self._cfg.grid_size_y, self._cfg.grid_size_z)
         return positions
     
     def _is_position_safe(self, x, y, z=None):
         """Check if position is within safe boundaries"""
-        # Get bed dimensions with fallback to legacy settings
-        bed_width = self._settings.get_float(["bed_width"]) or self._settings.get_float(["bed_max_x"])
-        bed_height = self._settings.get_float(["bed_height"]) or self._settings.get_float(["bed_max_y"])
-        margin = self._settings.get_float(["boundary_margin"])
-        max_z = self._settings.get_float(["max_z_height"])
-        
-        # Check X and Y boundaries
-        x_safe = margin <= x <= bed_width - margin
-        y_safe = margin <= y <= bed_height - margin
-        
-        # Check Z boundary if provided
-        z_safe = True
-        if z is not None:
-            z_safe = 0 <= z <= max_z
-        
-        return x_safe and y_safe and z_safe
+        cfg = self._cfg
+        margin = cfg.margin
+        return (margin <= x <= cfg.bed_w - margin
+                and margin <= y <= cfg.bed_h - margin
+                and (z is None or 0 <= z <= cfg.max_z))
     
     def _move_to_position(self, position):
         """Move printer head to specified position"""
+        gcode_command = self._movement_gcode(position)
+        self._logger.debug("Sending movement command: %s", gcode_command)
+        self._move_token += 1
+        self._printer.commands([gcode_command, "M400", f"@{MOVE_DONE_ATCOMMAND} {self._move_token}"])
+        
+        # Track the head position ourselves instead of asking the printer before every move
+        z = position.get("z")
+        if z is None and self._last_known_pos:
+            z = self._last_known_pos["z"]
+        self._last_known_pos = {"x": position["x"], "y": position["y"], "z": z}
+    
+    def _movement_gcode(self, position):
+        """Build the G1 command for a position"""
         x, y = position["x"], position["y"]
         z = position.get("z")  # Z coordinate is optional
-        speed = self._settings.get_int(["movement_speed"])
+        speed = self._cfg.movement_speed
         
         if z is not None:
-            gcode_command = f"G1 X{x:.3f} Y{y:.3f} Z{z:.3f} F{speed}"
+            return MOVE_XYZ_GCODE % (_format_coordinate(x), _format_coordinate(y), _format_coordinate(z), speed)
         else:
-            gcode_command = f"G1 X{x:.3f} Y{y:.3f} F{speed}"
+            return MOVE_XY_GCODE % (_format_coordinate(x), _format_coordinate(y), speed)
+    
+    def _wait_for_move(self, timeout):
+        """Wait until the printer reports the queued moves as finished"""
+        return self._move_done.wait(timeout=timeout)
+    
+    def on_atcommand_sending(self, comm, phase, command, parameters, tags=None, *args, **kwargs):
+        if command == MOVE_DONE_ATCOMMAND:
+            self._signal_move_done(parameters)
+        elif command == CAPTURE_ATCOMMAND:
+            self._hold_for_capture(parameters)
+    
+    def on_gcode_sending(self, comm, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        # Cancelling a print doesn't clear the send queue, so leftover grid moves are dropped here
+        if not self._session_aborted() or not tags:
+            return
+        if any(tag.startswith(GRID_COMMAND_TAG) for tag in tags):
+            self._logger.debug("Print ended, dropping queued grid command: %s", cmd)
+            return None,
+    
+    def _signal_move_done(self, parameters):
+        """Mark the pending move as finished, ignoring markers of earlier moves"""
+        try:
+            token = int(parameters)
+        except (TypeError, ValueError):
+            return
         
-        self._logger.debug(f"Sending movement command: {gcode_command}")
-        self._printer.commands([gcode_command])
+        if token == self._move_token:
+            self._move_done.set()
+    
+    def _hold_for_capture(self, parameters):
+        """Signal that a grid position was reached and hold the send queue until it is captured"""
+        try:
+            token, index = map(int, parameters.split())
+        except (AttributeError, TypeError, ValueError):
+            return
+        
+        # Markers left in the queue by an earlier sequence must not signal this one
+        current_token, slots = self._capture_slots
+        if token != current_token or not 0 <= index < len(slots):
+            return
+        
+        reached, released, expired = slots[index]
+        reached.set()
+        hold_timeout = self._cfg.pre_capture_delay + CAPTURE_SNAPSHOT_ALLOWANCE
+        if not released.wait(timeout=hold_timeout):
+            expired.set()
+            self._logger.warning("Capture at position %d took longer than %ss, continuing", index + 1, hold_timeout)
+    
+    def _release_capture_slots(self):
+        """Unblock any positions still held in the send queue, and wake a worker waiting on one"""
+        token, slots = self._capture_slots
+        for reached, released, _ in slots:
+            released.set()
+            reached.set()
+        self._capture_slots = (token, [])
+    
+    def _session_aborted(self):
+        """Whether the print ended or errored, after which the printer must be left alone"""
+        return self._print_ended.is_set() or self._printer_error.is_set()
     
     def _pause_print_safely(self):
         """Pause print with safety checks and timeout"""
@@ -515,14 +935,10 @@ class LayerCapturePlugin(
                 self._logger.debug("Print already paused")
                 return True
             
-            # Pause the print
+            # Pause the print and wait for PRINT_PAUSED with timeout
+            self._print_paused.clear()
             self._printer.pause_print()
-            
-            # Wait for pause to take effect with timeout
-            timeout = self._settings.get_int(["pause_timeout"])
-            start_time = time.time()
-            while not self._printer.is_paused() and (time.time() - start_time) < timeout:
-                time.sleep(0.5)
+            self._print_paused.wait(timeout=self._cfg.pause_timeout)
             
             if self._printer.is_paused():
                 self._logger.debug("Print paused successfully")
@@ -533,7 +949,7 @@ class LayerCapturePlugin(
                 return False
                 
         except Exception as e:
-            self._logger.error(f"Error pausing print: {e}")
+            self._logger.error("Error pausing print: %s", e)
             return False
     
     def _resume_print_safely(self):
@@ -546,14 +962,10 @@ class LayerCapturePlugin(
                 self._logger.debug("Print already running")
                 return True
             
-            # Resume the print
+            # Resume the print and wait for PRINT_RESUMED with timeout
+            self._print_resumed.clear()
             self._printer.resume_print()
-            
-            # Wait for resume to take effect with timeout
-            timeout = self._settings.get_int(["pause_timeout"])
-            start_time = time.time()
-            while self._printer.is_paused() and (time.time() - start_time) < timeout:
-                time.sleep(0.5)
+            self._print_resumed.wait(timeout=self._cfg.pause_timeout)
             
             if self._printer.is_printing() and not self._printer.is_paused():
                 self._logger.debug("Print resumed successfully")
@@ -563,7 +975,7 @@ class LayerCapturePlugin(
                 return False
                 
         except Exception as e:
-            self._logger.error(f"Error resuming print: {e}")
+            self._logger.error("Error resuming print: %s", e)
             return False
     
     def _move_to_position_safely(self, position):
@@ -574,41 +986,37 @@ class LayerCapturePlugin(
             
             # Validate position is safe
             if not self._is_position_safe(x, y):
-                self._logger.warning(f"Position {position} is not safe, skipping movement")
+                self._logger.warning("Position %s is not safe, skipping movement", position)
                 return False
             
             # Check Z height limit
-            max_z = self._settings.get_float(["max_z_height"])
+            max_z = self._cfg.max_z
             if z and z > max_z:
-                self._logger.warning(f"Z position {z} exceeds maximum {max_z}, skipping movement")
+                self._logger.warning("Z position %s exceeds maximum %s, skipping movement", z, max_z)
                 return False
             
-            # Get current position for comparison
-            current_pos = self._get_current_position()
-            
-            # Calculate movement distance for safety
-            if current_pos:
-                distance = ((x - current_pos["x"])**2 + (y - current_pos["y"])**2)**0.5
-                if distance > 200:  # Large movement safety check
-                    self._logger.warning(f"Large movement detected ({distance:.1f}mm), confirming safety")
-            
-            # Send movement command
-            if z is not None:
-                gcode_command = f"G1 X{x:.3f} Y{y:.3f} Z{z:.3f} F3000"
-            else:
-                gcode_command = f"G1 X{x:.3f} Y{y:.3f} F3000"
+            # Large movement safety check, the position is only needed for the warning
+            if self._logger.isEnabledFor(logging.WARNING):
+                current_pos = self._last_known_pos or self._get_current_position()
+                if current_pos:
+                    distance_sq = (x - current_pos["x"])**2 + (y - current_pos["y"])**2
+                    if distance_sq > 200 * 200:
+                        self._logger.warning("Large movement detected (%.1fmm), confirming safety", distance_sq**0.5)
             
-            self._logger.debug(f"Sending movement command: {gcode_command}")
-            self._printer.commands([gcode_command])
+            # Send movement command followed by M400
+            self._move_done.clear()
+            self._move_to_position(position)
             
             # Wait for movement to complete
-            movement_timeout = self._settings.get_int(["movement_timeout"])
-            time.sleep(movement_timeout)
+            movement_timeout = self._cfg.movement_timeout
+            if not self._wait_for_move(movement_timeout):
+                self._logger.warning("Movement to %s not confirmed within %ss", position, movement_timeout)
+                return False
             
             return True
             
         except Exception as e:
-            self._logger.error(f"Error moving to position {position}: {e}")
+            self._logger.error("Error moving to position %s: %s", position, e)
             return False
     
     def _emergency_resume_print(self):
@@ -617,114 +1025,148 @@ class LayerCapturePlugin(
             self._logger.warning("Attempting emergency print resume")
             
             # Force resume multiple times if needed
-            max_attempts = self._settings.get_int(["emergency_resume_attempts"])
+            max_attempts = self._cfg.emergency_attempts
             for attempt in range(max_attempts):
                 try:
+                    self._print_resumed.clear()
                     self._printer.resume_print()
-                    time.sleep(1)
+                    self._print_resumed.wait(timeout=1)
                     
                     if self._printer.is_printing() and not self._printer.is_paused():
                         self._logger.info("Emergency resume successful")
                         return True
                         
                 except Exception as e:
-                    self._logger.error(f"Emergency resume attempt {attempt + 1} failed: {e}")
-                    time.sleep(2)
+                    self._logger.error("Emergency resume attempt %d failed: %s", attempt + 1, e)
+                    # Back off before retrying, but stop right away once the printer reports an error
+                    if self._printer_error.wait(timeout=2):
+                        break
             
             self._logger.error("All emergency resume attempts failed")
             return False
             
         except Exception as e:
-            self._logger.error(f"Critical error in emergency resume: {e}")
+            self._logger.error("Critical error in emergency resume: %s", e)
             return False
     
-    def _capture_image(self, capture_data, position_index):
+    def _capture_image(self, capture_data, position_index, capture_dir, image_name_template):
         """Capture image at current position"""
         try:
-            # Create filename with better formatting
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            layer_str = f"{capture_data['layer']:04d}"
-            pos_str = f"{position_index:02d}"
-            z_height_str = f"{capture_data['z_height']:.2f}".replace('.', '_')
-            
-            filename = f"layer_{layer_str}_pos_{pos_str}_z_{z_height_str}_{timestamp}.jpg"
-            
-            # Create capture directory with date-based organization
-            capture_folder = self._settings.get(["capture_folder"])
-            date_folder = datetime.now().strftime("%Y-%m-%d")
-            capture_dir = os.path.join(
-                self._file_manager.get_folder_path("uploads"), 
-                capture_folder, 
-                date_folder
-            )
-            os.makedirs(capture_dir, exist_ok=True)
-            
+            filename = image_name_template.format(position_index)
             image_path = os.path.join(capture_dir, filename)
+            thumbnail_path = f"{os.path.splitext(image_path)[0]}_thumb.jpg"
             
             # Add pre-capture delay if configured
-            pre_capture_delay = self._settings.get_float(["pre_capture_delay"])
+            pre_capture_delay = self._cfg.pre_capture_delay
             if pre_capture_delay > 0:
-                self._logger.debug(f"Pre-capture delay: {pre_capture_delay}s")
+                self._logger.debug("Pre-capture delay: %ss", pre_capture_delay)
                 time.sleep(pre_capture_delay)
             
             # Capture based on mode
-            capture_start_time = time.time()
-            if self._settings.get_boolean(["use_fake_camera"]):
-                self._logger.debug(f"Using fake camera for position {position_index + 1}")
-                self._create_fake_image(image_path, capture_data, position_index)
+            capture_start_time = time.monotonic()
+            if self._cfg.use_fake:
+                # Fake images don't depend on the head position, render and write them in the background
+                self._logger.debug("Using fake camera for position %d", position_index + 1)
+                self._submit_write(self._write_fake_image, image_path, thumbnail_path, capture_data, position_index)
+                return image_path
             else:
-                self._logger.debug(f"Using real camera for position {position_index + 1}")
+                self._logger.debug("Using real camera for position %d", position_index + 1)
                 self._capture_real_image(image_path)
             
-            capture_duration = time.time() - capture_start_time
+            capture_duration = time.monotonic() - capture_start_time
             
             # Validate image was created
             if os.path.exists(image_path):
                 file_size = os.path.getsize(image_path)
-                self._logger.debug(f"Image captured successfully: {filename} ({file_size} bytes, {capture_duration:.2f}s)")
+                self._logger.debug("Image captured successfully: %s (%d bytes, %.2fs)", filename, file_size, capture_duration)
                 
-                # Optional: Create thumbnail for web viewing
-                if self._settings.get_boolean(["create_thumbnails"]):
-                    self._create_thumbnail(image_path)
+                # Optional: Create thumbnail for web viewing, off the capture path
+                if self._cfg.create_thumbnails:
+                    self._submit_write(self._create_thumbnail, image_path, thumbnail_path)
                 
                 return image_path
             else:
                 raise Exception("Image file was not created")
             
         except Exception as e:
-            self._logger.error(f"Failed to capture image at position {position_index}: {e}")
+            self._logger.error("Failed to capture image at position %d: %s", position_index, e)
             return None
     
-    def _create_thumbnail(self, image_path):
+    def _write_fake_image(self, image_path, thumbnail_path, capture_data, position_index):
+        """Create a fake image and its thumbnail, runs on the I/O pool"""
+        try:
+            if self._cfg.fake_minimal:
+                # Content doesn't matter for throughput tests, skip rendering and thumbnails
+                self._write_placeholder_image(image_path)
+                return
+            
+            self._create_fake_image(image_path, capture_data, position_index)
+            if self._cfg.create_thumbnails and os.path.exists(image_path):
+                self._create_thumbnail(image_path, thumbnail_path)
+        except Exception as e:
+            self._logger.error("Failed to write fake image %s: %s", image_path, e)
+    
+    def _get_capture_dir(self, capture_time):
+        """Return the date-based capture directory, creating it only when the date changes"""
+        date_folder = capture_time.strftime("%Y-%m-%d")
+        capture_root = self._capture_root
+        # (root, date, directory) is replaced as one tuple, a settings save may reset it concurrently
+        cached = self._capture_dir
+        if cached is not None and cached[:2] == (capture_root, date_folder):
+            return cached[2]
+        
+        capture_dir = os.path.join(capture_root, date_folder)
+        os.makedirs(capture_dir, exist_ok=True)
+        self._capture_dir = (capture_root, date_folder, capture_dir)
+        return capture_dir
+    
+    def _create_thumbnail(self, image_path, thumbnail_path):
         """Create a thumbnail for web viewing"""
+        if Image is None:
+            self._logger.warning("PIL not available for thumbnail creation")
+            return
+        
         try:
-            from PIL import Image
-            
-            thumbnail_path = image_path.replace('.jpg', '_thumb.jpg')
             thumbnail_size = (160, 120)
             
             with Image.open(image_path) as image:
-                image.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
+                # Let the JPEG decoder downscale via DCT scaling, the remaining resize is small
+                image.draft('RGB', thumbnail_size)
+                image.thumbnail(thumbnail_size, Image.Resampling.BILINEAR)
                 image.save(thumbnail_path, 'JPEG', quality=75)
                 
-            self._logger.debug(f"Created thumbnail: {thumbnail_path}")
+            self._logger.debug("Created thumbnail: %s", thumbnail_path)
             
-        except ImportError:
-            self._logger.warning("PIL not available for thumbnail creation")
         except Exception as e:
-            self._logger.warning(f"Failed to create thumbnail: {e}")
+            self._logger.warning("Failed to create thumbnail: %s", e)
     
-    def _create_fake_image(self, image_path, capture_data, position_index):
-        """Create a fake image file for testing"""
-        try:
-            from PIL import Image, ImageDraw, ImageFont
-            import io
-            
-            # Create a realistic fake image using PIL
+    def _get_fake_base(self):
+        """Return the static part of the fake image, rendered once and reused"""
+        if self._fake_base is None:
             width, height = 640, 480
             image = Image.new('RGB', (width, height), color='lightblue')
             draw = ImageDraw.Draw(image)
             
+            # Draw background pattern to simulate print bed
+            for i in range(0, width, 20):
+                draw.line([(i, 0), (i, height)], fill='lightgray', width=1)
+            for i in range(0, height, 20):
+                draw.line([(0, i), (width, i)], fill='lightgray', width=1)
+            
+            # Draw a simple "print object" in the center
+            object_x, object_y = width // 2, height // 2
+            object_size = min(width, height) // 4
+            draw.ellipse([
+                object_x - object_size//2, object_y - object_size//2,
+                object_x + object_size//2, object_y + object_size//2
+            ], fill='orange', outline='darkorange', width=2)
+            
+            self._fake_base = image
+        return self._fake_base
+    
+    def _get_fake_fonts(self):
+        """Return the fake image fonts, loaded from disk only on first use"""
+        if self._fake_fonts is None:
             # Try to use a basic font, fallback to default
             try:
                 font = ImageFont.truetype("arial.ttf", 20)
@@ -737,19 +1179,48 @@ class LayerCapturePlugin(
                     font = None
                     small_font = None
             
-            # Draw background pattern to simulate print bed
-            for i in range(0, width, 20):
-                draw.line([(i, 0), (i, height)], fill='lightgray', width=1)
-            for i in range(0, height, 20):
-                draw.line([(0, i), (width, i)], fill='lightgray', width=1)
+            self._fake_fonts = (font, small_font)
+        return self._fake_fonts
+    
+    def _get_fake_crosshair(self, width, height):
+        """Return the crosshair overlay and its paste origin, drawn once and cropped to its bounds"""
+        if self._fake_crosshair is None:
+            overlay = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(overlay)
+            
+            cross_size = 20
+            center_x, center_y = width // 2, height // 2
+            draw.line([
+                (center_x - cross_size, center_y),
+                (center_x + cross_size, center_y)
+            ], fill='red', width=2)
+            draw.line([
+                (center_x, center_y - cross_size),
+                (center_x, center_y + cross_size)
+            ], fill='red', width=2)
+            
+            bbox = overlay.getbbox()
+            self._fake_crosshair = (overlay.crop(bbox), bbox[:2])
+        return self._fake_crosshair
+    
+    def _create_fake_image(self, image_path, capture_data, position_index):
+        """Create a fake image file for testing"""
+        if Image is None:
+            # Fallback if PIL is not available - write the placeholder JPEG
+            self._logger.warning("PIL not available, writing placeholder image instead of fake image")
+            self._write_placeholder_image(image_path)
+            return
+        
+        try:
+            # Start from the cached static scene, only the layer-specific parts are drawn per image
+            image = self._get_fake_base().copy()
+            width, height = image.size
+            draw = ImageDraw.Draw(image)
+            
+            font, small_font = self._get_fake_fonts()
             
-            # Draw a simple "print object" in the center
             object_x, object_y = width // 2, height // 2
             object_size = min(width, height) // 4
-            draw.ellipse([
-                object_x - object_size//2, object_y - object_size//2,
-                object_x + object_size//2, object_y + object_size//2
-            ], fill='orange', outline='darkorange', width=2)
             
             # Add layer visualization (stack effect)
             layer_height = max(1, min(10, capture_data['layer'] // 5))
@@ -781,43 +1252,25 @@ class LayerCapturePlugin(
                     y_offset += 15
             
             # Add crosshair to show capture position
-            cross_size = 20
-            center_x, center_y = width // 2, height // 2
-            draw.line([
-                (center_x - cross_size, center_y),
-                (center_x + cross_size, center_y)
-            ], fill='red', width=2)
-            draw.line([
-                (center_x, center_y - cross_size),
-                (center_x, center_y + cross_size)
-            ], fill='red', width=2)
+            crosshair, crosshair_origin = self._get_fake_crosshair(width, height)
+            image.paste(crosshair, crosshair_origin, crosshair)
             
-            # Save as JPEG with configured quality
-            quality = self._settings.get_int(["image_quality"])
-            image.save(image_path, 'JPEG', quality=quality)
-            self._logger.debug(f"Created fake image: {image_path}")
-            
-        except ImportError:
-            # Fallback if PIL is not available - create a simple text file
-            self._logger.warning("PIL not available, creating simple text file instead of fake image")
-            fake_data = f"""FAKE IMAGE DATA - LayerCapture Plugin
-Layer: {capture_data['layer']}
-Position: {position_index + 1}
-Z-Height: {capture_data['z_height']:.2f}mm
-Time: {datetime.now()}
-File: {os.path.basename(capture_data.get('gcode_file', 'unknown.gcode'))}
-
-Note: Install PIL/Pillow for realistic fake images: pip install Pillow"""
+            # Save as JPEG with configured quality; 4:2:0 baseline keeps encoder work minimal
+            image.save(image_path, 'JPEG', quality=self._cfg.image_quality, subsampling=2, optimize=False, progressive=False)
+            self._logger.debug("Created fake image: %s", image_path)
             
-            with open(image_path.replace('.jpg', '.txt'), 'w') as f:
-                f.write(fake_data)
-                
         except Exception as e:
-            self._logger.error(f"Failed to create fake image: {e}")
-            # Ultra-simple fallback
-            fake_data = f"FAKE IMAGE - Layer: {capture_data['layer']}, Position: {position_index}, Time: {datetime.now()}"
-            with open(image_path.replace('.jpg', '.txt'), 'w') as f:
-                f.write(fake_data)
+            self._logger.error("Failed to create fake image: %s", e)
+            self._write_placeholder_image(image_path)
+    
+    def _write_placeholder_image(self, image_path):
+        """Write the pre-encoded placeholder JPEG so the image path always holds a valid JPEG"""
+        # A single small write, so skip the buffered file object
+        fd = os.open(image_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, PLACEHOLDER_JPEG)
+        finally:
+            os.close(fd)
     
     def _capture_real_image(self, image_path):
         """Capture real image using OctoPrint's webcam system"""
@@ -832,89 +1285,117 @@ Note: Install PIL/Pillow for realistic fake images: pip install Pillow"""
             if not webcam.config.canSnapshot:
                 raise WebcamNotAbleToTakeSnapshotException(webcam.config.name)
             
-            self._logger.debug(f"Capturing image from webcam '{webcam.config.name}' using provider '{webcam.providerIdentifier}'")
+            self._logger.debug("Capturing image from webcam '%s' using provider '%s'", webcam.config.name, webcam.providerIdentifier)
             
             # Take snapshot using the webcam provider plugin
             snapshot_data = webcam.providerPlugin.take_webcam_snapshot(webcam.config.name)
             
-            # Save the snapshot data to file
-            with open(image_path, 'wb') as f:
-                for chunk in snapshot_data:
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
+            # Save the snapshot data to file, the large buffer coalesces chunks and flushes once on close
+            with open(image_path, 'wb', buffering=SNAPSHOT_WRITE_BUFFER) as f:
+                f.writelines(filter(None, snapshot_data))
             
-            self._logger.debug(f"Successfully captured real image: {image_path}")
+            self._logger.debug("Successfully captured real image: %s", image_path)
             return True
             
         except WebcamNotAbleToTakeSnapshotException as e:
-            self._logger.error(f"Webcam '{e.webcam_name}' cannot take snapshots")
+            self._logger.error("Webcam '%s' cannot take snapshots", e.webcam_name)
             raise Exception(f"Webcam '{e.webcam_name}' is not configured for snapshots")
             
         except Exception as e:
-            self._logger.error(f"Failed to capture real image: {e}")
+            self._logger.error("Failed to capture real image: %s", e)
             raise Exception(f"Camera capture failed: {e}")
     
-    def _save_capture_metadata(self, capture_data, captured_images):
+    def _build_metadata_template(self):
+        """Build the metadata fields that stay fixed for every capture of this print"""
+        settings = {
+            "grid_spacing": self._settings.get_float(["grid_spacing"]),
+            "grid_center": {
+                "x": self._settings.get_float(["grid_center_x"]),
+                "y": self._settings.get_float(["grid_center_y"])
+            },
+            "grid_size": self._settings.get_int(["grid_size"]),
+            "z_offset": self._settings.get_float(["z_offset"]),
+            "image_quality": self._settings.get_int(["image_quality"]),
+            "movement_speed": self._settings.get_int(["movement_speed"]),
+            "pre_capture_delay": self._settings.get_float(["pre_capture_delay"]),
+            "calibration_file_path": self._current_calibration_file  # Also include in settings
+        }
+        
+        # Per-capture keys are listed as None so the file keeps its field order when they are filled in
+        return {
+            "layer": None,
+            "z_height": None,
+            "timestamp": None,
+            "timestamp_iso": None,
+            "gcode_file": None,
+            "calibration_file_path": None,
+            "print_start_time": self._print_start_time,
+            "print_start_time_iso": self._print_start_time_iso,
+            "images": None,
+            "camera": None,
+            "settings": settings,
+            "plugin_version": __plugin_version__
+        }
+    
+    def _save_capture_metadata(self, capture_data, captured_images, capture_dir, metadata_filename):
         """Save JSON metadata for the capture session"""
         # Get camera information
         camera_info = self._get_camera_info()
         
-        metadata = {
+        metadata = dict(capture_data["metadata_template"])
+        metadata.update({
             "layer": capture_data["layer"],
             "z_height": capture_data["z_height"],
             "timestamp": capture_data["timestamp"],
-            "timestamp_iso": datetime.fromtimestamp(capture_data["timestamp"]).isoformat(),
+            "timestamp_iso": capture_data["timestamp_iso"],
             "gcode_file": capture_data["gcode_file"],
             "calibration_file_path": capture_data.get("calibration_file_path"),  # Include calibration file path
-            "print_start_time": self._print_start_time,
-            "print_start_time_iso": datetime.fromtimestamp(self._print_start_time).isoformat() if self._print_start_time else None,
             "images": captured_images,
-            "camera": camera_info,
-            "settings": {
-                "grid_spacing": self._settings.get_float(["grid_spacing"]),
-                "grid_center": {
-                    "x": self._settings.get_float(["grid_center_x"]),
-                    "y": self._settings.get_float(["grid_center_y"])
-                },
-                "grid_size": self._settings.get_int(["grid_size"]),
-                "z_offset": self._settings.get_float(["z_offset"]),
-                "image_quality": self._settings.get_int(["image_quality"]),
-                "movement_speed": self._settings.get_int(["movement_speed"]),
-                "capture_delay": self._settings.get_int(["capture_delay"]),
-                "pre_capture_delay": self._settings.get_float(["pre_capture_delay"]),
-                "calibration_file_path": self._settings.get(["calibration_file_path"])  # Also include in settings
-            },
-            "plugin_version": __plugin_version__
-        }
+            "camera": camera_info
+        })
         
         # Save metadata file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        metadata_filename = f"layer_{capture_data['layer']:04d}_metadata_{timestamp}.json"
-        capture_folder = self._settings.get(["capture_folder"])
-        date_folder = datetime.now().strftime("%Y-%m-%d")
-        capture_dir = os.path.join(
-            self._file_manager.get_folder_path("uploads"), 
-            capture_folder, 
-            date_folder
-        )
         metadata_path = os.path.join(capture_dir, metadata_filename)
         
         try:
-            with open(metadata_path, 'w') as f:
-                json.dump(metadata, f, indent=2)
-            self._logger.debug(f"Metadata saved: {metadata_path}")
+            payload = _dump_json(metadata)
+        except Exception as e:
+            self._logger.error("Failed to serialize metadata: %s", e)
+            return
+        
+        self._submit_write(self._write_metadata_file, metadata_path, payload)
+    
+    def _submit_write(self, fn, *args):
+        """Run a file write on the I/O pool and track it until the sequence waits for it"""
+        self._pending_writes.append(self._io_pool.submit(fn, *args))
+    
+    def _wait_for_pending_writes(self):
+        """Block until the writes submitted by this sequence are done"""
+        pending, self._pending_writes = self._pending_writes, []
+        if not pending:
+            return
+        _, not_done = concurrent.futures.wait(pending, timeout=PENDING_WRITES_TIMEOUT)
+        if not_done:
+            self._logger.warning("%d file writes still running after %ds, resuming anyway", len(not_done), PENDING_WRITES_TIMEOUT)
+    
+    def _write_metadata_file(self, metadata_path, payload):
+        """Write serialized metadata to disk, runs on the I/O pool"""
+        try:
+            with open(metadata_path, 'wb') as f:
+                f.write(payload)
+            self._logger.debug("Metadata saved: %s", metadata_path)
         except Exception as e:
-            self._logger.error(f"Failed to save metadata: {e}")
+            self._logger.error("Failed to save metadata: %s", e)
     
     def _get_camera_info(self):
         """Get information about the camera being used"""
+        use_fake = self._cfg.use_fake
         camera_info = {
-            "type": "fake" if self._settings.get_boolean(["use_fake_camera"]) else "real",
+            "type": "fake" if use_fake else "real",
             "timestamp": datetime.now().isoformat()
         }
         
-        if not self._settings.get_boolean(["use_fake_camera"]):
+        if not use_fake:
             try:
                 from octoprint.webcams import get_snapshot_webcam
                 
@@ -949,12 +1430,29 @@ Note: Install PIL/Pillow for realistic fake images: pip install Pillow"""
     
     def _cleanup_capture_session(self):
         """Clean up after print session ends"""
-        self._capture_queue.clear()
-        self._target_layers.clear()
-        self._current_layer = 0
+        self._print_ended.set()
+        
+        # Drop any captures still waiting for the worker
+        while not self._capture_q.empty():
+            try:
+                self._capture_q.get_nowait()
+                self._capture_q.task_done()
+            except queue.Empty:
+                break
+        
+        # Never leave the send queue held at a capture position
+        self._release_capture_slots()
+        
+        self._target_layers = TargetLayers()
+        self._target_layer_list = []
+        self._last_z = None
+        self._next_target_z = float("inf")
         self._print_start_time = None
+        self._print_start_time_iso = None
         self._current_gcode_file = None
         self._current_calibration_file = "" # Clear calibration file path on session end
+        self._metadata_template = None
+        self._last_known_pos = None
         self._capture_in_progress = False
 
 
@@ -969,5 +1467,7 @@ __plugin_implementation__ = LayerCapturePlugin()
 
 # Plugin hooks
 __plugin_hooks__ = {
-    "octoprint.events.register_custom_events": lambda: ["layer_capture_started", "layer_capture_completed", "layer_capture_failed"]
+    "octoprint.events.register_custom_events": lambda: ["layer_capture_started", "layer_capture_completed", "layer_capture_failed"],
+    "octoprint.comm.protocol.atcommand.sending": __plugin_implementation__.on_atcommand_sending,
+    "octoprint.comm.protocol.gcode.sending": __plugin_implementation__.on_gcode_sending
 } 
\ No newline at end of file
@@ -7,10 +7,71 @@ This script helps validate installation and basic functionality.
 import sys
 import importlib.util
 import json
+import logging
+import queue
 import tempfile
 import os
 from datetime import datetime
 
+class MockSettings:
+    """Settings backed by the plugin defaults, with optional overrides."""
+    def __init__(self, values):
+        self.values = values
+    
+    def get(self, key_path, **kwargs):
+        return self.values.get(key_path[0])
+    
+    def get_float(self, key_path, **kwargs):
+        value = self.values.get(key_path[0])
+        return None if value is None else float(value)
+    
+    def get_int(self, key_path, **kwargs):
+        value = self.values.get(key_path[0])
+        return None if value is None else int(value)
+    
+    def get_boolean(self, key_path, **kwargs):
+        return bool(self.values.get(key_path[0]))
+
+class MockFileManager:
+    def get_folder_path(self, folder):
+        return tempfile.gettempdir()
+
+class MockPluginManager:
+    def send_plugin_message(self, identifier, data):
+        pass
+
+class MockPrinter:
+    def __init__(self):
+        self.paused = False
+    
+    def is_printing(self):
+        return not self.paused
+    
+    def is_operational(self):
+        return True
+    
+    def is_paused(self):
+        return self.paused
+    
+    def is_cancelling(self):
+        return False
+
+def make_configured_plugin(**overrides):
+    """Create a plugin with mocked OctoPrint services and its settings cache built, as after initialize()."""
+    from octoprint_layercapture import LayerCapturePlugin
+    plugin = LayerCapturePlugin()
+    values = plugin.get_settings_defaults()
+    values.update(overrides)
+    plugin._settings = MockSettings(values)
+    plugin._file_manager = MockFileManager()
+    plugin._printer = MockPrinter()
+    plugin._plugin_manager = MockPluginManager()
+    plugin._logger = logging.getLogger("test_layercapture")
+    # Queued captures stay here instead of reaching the worker thread
+    plugin._capture_q = queue.Queue()
+    plugin._refresh_settings_cache()
+    return plugin
+
 def test_plugin_import():
     """Test if the plugin can be imported successfully."""
     print("Testing plugin import...")
@@ -63,20 +124,7 @@ def test_grid_calculation(plugin):
     """Test grid position calculation."""
     print("Testing grid position calculation...")
     try:
-        # Mock settings for testing
-        class MockSettings:
-            def __init__(self, defaults):
-                self.defaults = defaults
-            
-            def get_float(self, key_path):
-                key = key_path[0] if isinstance(key_path, list) else key_path
-                return float(self.defaults.get(key, 0))
-            
-            def get_int(self, key_path):
-                key = key_path[0] if isinstance(key_path, list) else key_path
-                return int(self.defaults.get(key, 0))
-        
-        plugin._settings = MockSettings(plugin.get_settings_defaults())
+        plugin = make_configured_plugin()
         
         positions = plugin._calculate_grid_positions()
         
@@ -84,6 +132,20 @@ def test_grid_calculation(plugin):
             print("✗ Grid calculation returned no positions")
             return False
         
+        # Each XY point is visited once, top Z first, and the serpentine never jumps back a column
+        xy_points = []
+        for pos in positions:
+            if not xy_points or xy_points[-1] != (pos['x'], pos['y']):
+                xy_points.append((pos['x'], pos['y']))
+                z_values = []
+            z_values.append(pos['z'])
+            if z_values != sorted(z_values, reverse=True):
+                print("✗ Grid Z positions are not visited top-down")
+                return False
+        if len(set(xy_points)) != len(xy_points) or any(abs(a[0] - b[0]) > plugin._cfg.spacing_x for a, b in zip(xy_points, xy_points[1:])):
+            print("✗ Grid XY traversal is not a serpentine")
+            return False
+        
         print(f"✓ Grid calculation successful - {len(positions)} positions generated")
         for i, pos in enumerate(positions[:5]):  # Show first 5 positions
             print(f"  Position {i+1}: X={pos['x']}, Y={pos['y']}")
@@ -99,18 +161,7 @@ def test_safety_check(plugin):
     """Test boundary safety checking."""
     print("Testing safety boundary checking...")
     try:
-        # Mock settings
-        class MockSettings:
-            def get_float(self, key_path):
-                key = key_path[0] if isinstance(key_path, list) else key_path
-                defaults = {
-                    'bed_width': 200,
-                    'bed_height': 200,
-                    'boundary_margin': 10
-                }
-                return float(defaults.get(key, 0))
-        
-        plugin._settings = MockSettings()
+        plugin = make_configured_plugin(bed_width=200, bed_height=200, boundary_margin=10)
         
         # Test safe position
         safe_result = plugin._is_position_safe(100, 100)
@@ -124,16 +175,213 @@ def test_safety_check(plugin):
             print("✗ Unsafe position incorrectly marked as safe")
             return False
         
+        # Test Z limits (default max Z height is 300mm)
+        if not plugin._is_position_safe(100, 100, 50) or plugin._is_position_safe(100, 100, 350):
+            print("✗ Z limit checking is incorrect")
+            return False
+        
         print("✓ Safety boundary checking working correctly")
         return True
     except Exception as e:
         print(f"✗ Safety check test failed: {e}")
         return False
 
+def test_z_threshold():
+    """Test that Z changes trigger captures on target layers only, and never skip one."""
+    print("Testing Z change capture threshold...")
+    try:
+        # Grid moves land 6mm above the layer, which rounds onto target layers of every_n=3
+        plugin = make_configured_plugin(capture_every_n_layers=3, min_layer_height=0.2, z_offset_base=6)
+        plugin._on_print_started({"file": {"path": "test.gcode"}})
+        
+        def z_change(old, new):
+            plugin._on_z_change({"old": old, "new": new})
+        
+        def queued_layers():
+            layers = []
+            while not plugin._capture_q.empty():
+                layers.append(plugin._capture_q.get_nowait()["layer"])
+            return layers
+        
+        # Layers 1-3 print normally, only layer 3 is captured
+        for layer in range(1, 4):
+            z_change(round((layer - 1) * 0.2, 2), round(layer * 0.2, 2))
+        if queued_layers() != [3]:
+            print("✗ Layer 3 was not captured exactly once")
+            return False
+        
+        # Z changes from our own grid moves land on target layers but must not trigger or skip them
+        z_change(0.6, 6.6)
+        z_change(6.6, 11.6)
+        z_change(11.6, 0.6)
+        if queued_layers():
+            print("✗ Grid moves during a capture triggered another capture")
+            return False
+        plugin._capture_in_progress = False
+        
+        for layer in range(4, 7):
+            z_change(round((layer - 1) * 0.2, 2), round(layer * 0.2, 2))
+        if queued_layers() != [6]:
+            print("✗ Layer 6 was not captured after the grid moves")
+            return False
+        plugin._capture_in_progress = False
+        
+        # A refused capture (printer paused) must not move the threshold past the layer
+        plugin._printer.paused = True
+        for layer in range(7, 10):
+            z_change(round((layer - 1) * 0.2, 2), round(layer * 0.2, 2))
+        plugin._printer.paused = False
+        if queued_layers() or plugin._next_target_z > 9 * 0.2:
+            print("✗ Refused capture at layer 9 advanced the threshold")
+            return False
+        
+        for layer in range(10, 13):
+            z_change(round((layer - 1) * 0.2, 2), round(layer * 0.2, 2))
+        if queued_layers() != [12]:
+            print("✗ Layer 12 was not captured after a refused capture")
+            return False
+        
+        # A start G-code lift to Z15 lands on a target, the print then drops back to the first layer
+        plugin = make_configured_plugin(capture_every_n_layers=3, min_layer_height=0.2)
+        plugin._on_print_started({"file": {"path": "test.gcode"}})
+        captured = []
+        
+        def print_moves(moves):
+            for old, new in moves:
+                z_change(old, new)
+                captured.extend(queued_layers())
+                plugin._capture_in_progress = False
+        
+        layer_moves = [(round((layer - 1) * 0.2, 2), round(layer * 0.2, 2)) for layer in range(2, 19)]
+        print_moves([(None, 15.0), (15.0, 0.2)] + layer_moves)
+        if captured != [75, 3, 6, 9, 12, 15, 18]:
+            print(f"✗ Start lift captured {captured}, expected [75, 3, 6, 9, 12, 15, 18]")
+            return False
+        
+        # Sequential ("one at a time") prints drop Z back down for the next object
+        captured.clear()
+        print_moves([(3.6, 0.2)] + layer_moves[:5])
+        if captured != [3, 6]:
+            print(f"✗ Second object captured {captured}, expected [3, 6]")
+            return False
+        
+        print("✓ Z change threshold working correctly")
+        return True
+    except Exception as e:
+        print(f"✗ Z threshold test failed: {e}")
+        return False
+
+def test_thin_layers():
+    """Test that layers thinner than min_layer_height and vase-mode Z creep still trigger captures."""
+    print("Testing thin layer captures...")
+    try:
+        # 0.02mm steps stand in for spiral/vase mode, where Z rises continuously
+        for layer_height in (0.16, 0.15, 0.12, 0.02):
+            plugin = make_configured_plugin(capture_every_n_layers=3, min_layer_height=0.2)
+            plugin._on_print_started({"file": {"path": "test.gcode"}})
+            
+            captured = []
+            z = 0.0
+            while z < 2.0:
+                old_z, z = z, round(z + layer_height, 3)
+                plugin._on_z_change({"old": old_z, "new": z})
+                while not plugin._capture_q.empty():
+                    captured.append(plugin._capture_q.get_nowait()["layer"])
+                    plugin._capture_in_progress = False
+            
+            if captured != [3, 6, 9]:
+                print(f"✗ {layer_height}mm layers captured {captured}, expected [3, 6, 9]")
+                return False
+        
+        print("✓ Thin layer captures working correctly")
+        return True
+    except Exception as e:
+        print(f"✗ Thin layer test failed: {e}")
+        return False
+
+def test_target_layers():
+    """Test target layer membership, ordering and lookup of the next target."""
+    print("Testing target layer lookup...")
+    try:
+        from octoprint_layercapture import TargetLayers, _format_coordinate
+        
+        # Every 5th layer up to 20, plus extra layers from specific Z heights (one beyond max, one duplicate)
+        targets = TargetLayers(5, 20, [7, 10, 23])
+        expected = [5, 7, 10, 15, 20, 23]
+        
+        if list(targets) != expected or len(targets) != len(expected):
+            print(f"✗ Target layers {list(targets)} != {expected}")
+            return False
+        
+        if any(layer not in targets for layer in expected) or any(layer in targets for layer in (0, 4, 6, 21, -1)):
+            print("✗ Target layer membership is incorrect")
+            return False
+        
+        next_after = {-1: 5, 0: 5, 5: 7, 7: 10, 11: 15, 20: 23, 23: None}
+        for layer, following in next_after.items():
+            if targets.next_after(layer) != following:
+                print(f"✗ next_after({layer}) returned {targets.next_after(layer)}, expected {following}")
+                return False
+        
+        if list(TargetLayers()) or TargetLayers().next_after(0) is not None:
+            print("✗ Empty target layers are not empty")
+            return False
+        
+        coordinates = {105.0: "105", 12.5: "12.5", 0.1234: "0.123", -0.0001: "0", -3.25: "-3.25"}
+        for value, formatted in coordinates.items():
+            if _format_coordinate(value) != formatted:
+                print(f"✗ Coordinate {value} formatted as {_format_coordinate(value)}, expected {formatted}")
+                return False
+        
+        print("✓ Target layer lookup working correctly")
+        return True
+    except Exception as e:
+        print(f"✗ Target layer test failed: {e}")
+        return False
+
+def test_metadata_template():
+    """Test that metadata keeps its field order and survives the session ending mid-capture."""
+    print("Testing capture metadata...")
+    try:
+        plugin = make_configured_plugin()
+        plugin._on_print_started({"file": {"path": "test.gcode"}})
+        plugin._on_z_change({"old": 0.4, "new": 0.6})
+        capture_data = plugin._capture_q.get_nowait()
+        capture_data["timestamp_iso"] = datetime.fromtimestamp(capture_data["timestamp"]).isoformat()
+        
+        # The print is cancelled while the queued sequence is still running
+        plugin._cleanup_capture_session()
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            plugin._save_capture_metadata(capture_data, [], temp_dir, "metadata.json")
+            plugin._wait_for_pending_writes()
+            with open(os.path.join(temp_dir, "metadata.json")) as f:
+                metadata = json.load(f)
+        
+        expected_keys = [
+            "layer", "z_height", "timestamp", "timestamp_iso", "gcode_file", "calibration_file_path",
+            "print_start_time", "print_start_time_iso", "images", "camera", "settings", "plugin_version"
+        ]
+        if list(metadata) != expected_keys:
+            print(f"✗ Metadata fields out of order: {list(metadata)}")
+            return False
+        
+        if metadata["layer"] != 3 or metadata["gcode_file"] != "test.gcode" or metadata["settings"] is None:
+            print("✗ Metadata content is incorrect")
+            return False
+        
+        print("✓ Capture metadata working correctly")
+        return True
+    except Exception as e:
+        print(f"✗ Metadata test failed: {e}")
+        return False
+
 def test_fake_image_creation(plugin):
     """Test fake image creation for debugging."""
     print("Testing fake image creation...")
     try:
+        plugin = make_configured_plugin()
+        
         with tempfile.TemporaryDirectory() as temp_dir:
             image_path = os.path.join(temp_dir, "test_image.jpg")
             capture_data = {
@@ -148,13 +396,35 @@ def test_fake_image_creation(plugin):
                 print("✗ Fake image file was not created")
                 return False
             
-            with open(image_path, 'r') as f:
+            # Rendered with PIL when available, otherwise the placeholder; either way a JPEG
+            with open(image_path, 'rb') as f:
                 content = f.read()
             
-            if "FAKE IMAGE" not in content or "Layer: 10" not in content:
-                print("✗ Fake image content is incorrect")
+            if not content.startswith(b"\xff\xd8"):
+                print("✗ Fake image is not a JPEG file")
                 return False
             
+            try:
+                from PIL import Image
+            except ImportError:
+                Image = None
+            if Image is not None:
+                with Image.open(image_path) as image:
+                    if image.format != "JPEG" or image.size != (640, 480):
+                        print(f"✗ Fake image is {image.format} {image.size}, expected a 640x480 JPEG")
+                        return False
+            
+            # Minimal mode writes the pre-encoded placeholder without rendering or thumbnails
+            minimal = make_configured_plugin(fake_minimal=True)
+            minimal_path = os.path.join(temp_dir, "test_minimal.jpg")
+            thumbnail_path = os.path.join(temp_dir, "test_minimal_thumb.jpg")
+            minimal._write_fake_image(minimal_path, thumbnail_path, capture_data, 0)
+            
+            with open(minimal_path, 'rb') as f:
+                if not f.read().startswith(b"\xff\xd8") or os.path.exists(thumbnail_path):
+                    print("✗ Minimal fake image is incorrect")
+                    return False
+            
             print("✓ Fake image creation working correctly")
             return True
     except Exception as e:
@@ -168,7 +438,7 @@ def run_all_tests():
     print("=" * 50)
     
     tests_passed = 0
-    total_tests = 6
+    total_tests = 10
     
     # Test 1: Import
     if test_plugin_import():
@@ -206,6 +476,26 @@ def run_all_tests():
         tests_passed += 1
     print()
     
+    # Test 7: Z change threshold
+    if test_z_threshold():
+        tests_passed += 1
+    print()
+    
+    # Test 8: Target layer lookup
+    if test_target_layers():
+        tests_passed += 1
+    print()
+    
+    # Test 9: Capture metadata
+    if test_metadata_template():
+        tests_passed += 1
+    print()
+    
+    # Test 10: Thin layers
+    if test_thin_layers():
+        tests_passed += 1
+    print()
+    
     print("=" * 50)
     print(f"Final Result: {tests_passed}/{total_tests} tests passed")
     